@@ -9,30 +9,89 @@ import os
 import sys
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta, timezone
 import re
 import argparse
 import time
+import random
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
 from urllib.parse import quote
 from functools import wraps
+from cachetools import LRUCache, TLRUCache
 import base64
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson  # Faster JSON parsing for large tag listings
+except ImportError:
+    orjson = None
+
+# Server errors worth retrying after the delay the server asks for
+RETRYABLE_SERVER_ERRORS = {
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+}
+
+# Image build times before Docker's first release are placeholders (e.g. reproducible builds use the Unix epoch)
+EARLIEST_PLAUSIBLE_BUILD = datetime(2013, 3, 1, tzinfo=timezone.utc)
+
+
+class TokenResponseError(requests.exceptions.RequestException):
+    """The auth service answered without a JSON token (e.g. a login page); retrying won't change that"""
 
 
 class DockerHubCleaner:
-    def __init__(self, username, password, dry_run=False, verbose=False, protected_tags=None, custom_patterns=None):
+    def __init__(self, username, password, dry_run=False, verbose=False, protected_tags=None, custom_patterns=None, concurrency=8, source="auto", stream=None, keep_repository_stats=None):
         self.username = username
         self.password = password  # Can be password or Personal Access Token
+        credentials = f"{username}:{password}"
+        self._basic_auth = f"Basic {base64.b64encode(credentials.encode()).decode('ascii')}"
         self.dry_run = dry_run
         self.verbose = verbose
-        self.protected_tags = protected_tags or []
+        self.protected_tags = set(protected_tags or ())
         self.custom_patterns = custom_patterns or {}
+        self.source = source  # Where tags are listed from: 'auto', 'hub' or 'registry'
         self.hub_url = "https://hub.docker.com/v2"
         self.auth_url = "https://auth.docker.io"
         self.registry_url = "https://registry-1.docker.io/v2"
-        self.tokens = {}  # Cache tokens per repository
+        self.manifest_accept = ", ".join([
+            "application/vnd.docker.distribution.manifest.v2+json",
+            "application/vnd.oci.image.manifest.v1+json",
+            "application/vnd.docker.distribution.manifest.list.v2+json",
+            "application/vnd.oci.image.index.v1+json"
+        ])
+        # Cache tokens per scope; entries are evicted once they expire or the cache is full
+        self.tokens = TLRUCache(maxsize=512, ttu=lambda scope, token_data, now: token_data['expires_at'], timer=time.monotonic)
+        self._tokens_lock = threading.Lock()  # cachetools caches are not thread-safe
+        # One fetch lock per scope, so workers don't race for the same token; bounded like the token cache
+        self._token_locks = LRUCache(maxsize=512)
         self.request_timeout = 30  # 30 seconds timeout for API requests
         self.max_retries = 3
         self.retry_delay = 1  # Initial delay in seconds
+        self.max_retry_delay = 60  # Cap for exponential backoff
+        self.rate_limit_threshold = 5  # Pause when fewer requests than this remain
+        self.max_rate_limit_wait = 300  # Never pause longer than 5 minutes for a reset
+        self.concurrency = max(1, concurrency)  # Max parallel per-tag registry calls across all repositories
+        self._tag_slots = threading.BoundedSemaphore(self.concurrency)
+        
+        # Reuse one session so connections to auth/registry/hub are kept alive.
+        # The pool must hold a connection per worker, or urllib3 discards them and keep-alive is lost.
+        self.session = requests.Session()
+        pool_size = max(32, self.concurrency)
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = "lostlink-docker-cleanup"
+        
+        # Cleared while cooling down for a rate-limit reset so all workers pause together
+        self._rate_gate = threading.Event()
+        self._rate_gate.set()
+        self._rate_lock = threading.Lock()
         
         # Track statistics for output
         self.stats = {
@@ -41,6 +100,23 @@ class DockerHubCleaner:
             "protected_count": 0,
             "repositories": []
         }
+        self._stats_lock = threading.Lock()  # Stats are updated from worker threads
+        self.stream = stream  # Binary file receiving one JSON line per repository
+        # Per-repository stats are only kept in memory when nothing else records them, unless asked for
+        self.keep_repository_stats = stream is None if keep_repository_stats is None else keep_repository_stats
+        
+        # Compile tag patterns once instead of for every tag.
+        # Built-in patterns are fused so a single match tells protected, PR and SHA tags apart.
+        self._classifier = re.compile(
+            r'^(?P<protected>latest|main|master|develop|\d+\.\d+\.\d+|v\d+\.\d+\.\d+|\d+\.\d+|\d+)$'
+            r'|^(?P<pr>pr-\d+)$'
+            r'|^(?P<sha>(?:main|master|develop)-[a-f0-9]{7,})$'
+        )
+        # Custom patterns are user-supplied regexes, kept separate so their groups and flags stay intact.
+        # Their cutoffs only depend on the run start time, so they are computed here as well.
+        run_started = datetime.now(timezone.utc)
+        self._custom_cutoffs = [(re.compile(pattern_str), run_started - timedelta(days=retention_days))
+                                for pattern_str, retention_days in self.custom_patterns.items()]
         
     def log(self, message, level="INFO"):
         """Log message with timestamp"""
@@ -66,31 +142,128 @@ class DockerHubCleaner:
                     self.log(f"⏱️  Request timeout (attempt {attempt + 1}/{self.max_retries})", "WARNING")
                 
                 except requests.exceptions.HTTPError as e:
-                    if e.response.status_code == 429:  # Rate limited
-                        retry_after = int(e.response.headers.get('Retry-After', delay))
-                        self.log(f"⚠️  Rate limited, waiting {retry_after} seconds...", "WARNING")
-                        time.sleep(retry_after)
-                        continue
-                    elif e.response.status_code == 401:  # Unauthorized
-                        self.log(f"  Authentication issue (401): {e}", "DEBUG")
-                        # Don't retry auth errors
-                        raise e
+                    status = e.response.status_code
+                    if status == HTTPStatus.UNAUTHORIZED:
+                        # Don't retry auth errors; the caller reports them
+                        raise
+                    
                     last_exception = e
+                    retry_after = self.parse_retry_after(e.response.headers.get('Retry-After'))
+                    if retry_after is not None:
+                        # Same ceiling as proactive throttling, so a far-off HTTP-date can't stall a worker
+                        retry_after = min(retry_after, self.max_rate_limit_wait)
+                    is_last_attempt = attempt == self.max_retries - 1
+                    if status == HTTPStatus.TOO_MANY_REQUESTS:
+                        if not is_last_attempt:
+                            wait = retry_after if retry_after is not None else delay * random.uniform(0.5, 1.5)
+                            self.log(f"⚠️  Rate limited, waiting {wait:.1f} seconds...", "WARNING")
+                            time.sleep(wait)
+                            delay = min(delay * 2, self.max_retry_delay)
+                        continue
+                    elif status in RETRYABLE_SERVER_ERRORS and retry_after is not None:
+                        # Server asked us to come back later; honor it instead of our own backoff
+                        if not is_last_attempt:
+                            self.log(f"⚠️  Server error {status}, retrying after {retry_after:.1f} seconds...", "WARNING")
+                            time.sleep(retry_after)
+                        continue
+                    # Other errors (including 5xx without Retry-After) use the regular backoff below
+                
+                except TokenResponseError:
+                    raise
                 
                 except requests.exceptions.RequestException as e:
                     last_exception = e
                     self.log(f"⚠️  Request failed (attempt {attempt + 1}/{self.max_retries}): {e}", "WARNING")
                 
                 if attempt < self.max_retries - 1:
-                    self.log(f"⏳ Waiting {delay} seconds before retry...", "DEBUG")
-                    time.sleep(delay)
-                    delay *= 2  # Exponential backoff
+                    # Jitter keeps parallel workers from retrying in lockstep
+                    wait = delay * random.uniform(0.5, 1.5)
+                    self.log(f"⏳ Waiting {wait:.1f} seconds before retry...", "DEBUG")
+                    time.sleep(wait)
+                    delay = min(delay * 2, self.max_retry_delay)  # Exponential backoff
             
             # All retries exhausted
             raise last_exception if last_exception else Exception("Max retries exceeded")
         
         return wrapper
     
+    def parse_json(self, response):
+        """Parse a JSON response body, using orjson when it is installed"""
+        if orjson is None:
+            return response.json()
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError as e:
+            # Raise the same error type as response.json() so callers' RequestException handling still applies
+            raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
+    
+    def parse_retry_after(self, value):
+        """
+        Parse a Retry-After header value into seconds to wait.
+        Accepts both delay-seconds and HTTP-date formats; returns None if absent or invalid.
+        """
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    
+    def _check_rate_limit(self, response):
+        """Pause all workers when the rate-limit headers say we are about to be throttled"""
+        # Registry sends 'ratelimit-remaining: 76;w=21600', Hub API sends 'x-ratelimit-remaining: 76'
+        remaining = response.headers.get("ratelimit-remaining") or response.headers.get("x-ratelimit-remaining")
+        if not remaining:
+            return
+        try:
+            remaining = int(remaining.split(";")[0])
+        except ValueError:
+            return
+        if remaining >= self.rate_limit_threshold:
+            return
+        
+        reset = response.headers.get("ratelimit-reset") or response.headers.get("x-ratelimit-reset") or "1"
+        try:
+            wait = float(reset.split(";")[0])
+        except ValueError:
+            wait = 1.0
+        if wait > 1e9:  # Hub API reports reset as a Unix timestamp
+            wait -= time.time()
+        wait = min(max(wait, 0.0), self.max_rate_limit_wait)
+        
+        with self._rate_lock:
+            owner = self._rate_gate.is_set()
+            if owner:
+                self._rate_gate.clear()
+        
+        if owner:
+            self.log(f"⚠️  Only {remaining} requests left before rate limit, pausing {wait:.1f} seconds...", "WARNING")
+            try:
+                time.sleep(wait)
+            finally:
+                self._rate_gate.set()
+        else:
+            self._rate_gate.wait()
+    
+    def parse_timestamp(self, value):
+        """Parse an ISO 8601 timestamp from the Docker APIs into an aware UTC datetime"""
+        try:
+            # Docker Hub dates end with 'Z' for UTC, which fromisoformat only accepts from Python 3.11
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            # Older Pythons reject nanosecond fractions; fall back to the seconds-only prefix
+            parsed = datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+        if parsed.tzinfo is None:
+            return parsed.replace(tzinfo=timezone.utc)
+        return parsed
+    
     def parse_repository_spec(self, repo_spec):
         """
         Parse repository specification to extract namespace and repository name.
@@ -107,59 +280,70 @@ class DockerHubCleaner:
             raise ValueError(f"Invalid repository format: {repo_spec}. Use 'repository' or 'namespace/repository'")
     
     def get_basic_auth_header(self):
-        """Get basic auth header for authentication"""
-        credentials = f"{self.username}:{self.password}"
-        encoded = base64.b64encode(credentials.encode()).decode('ascii')
-        return f"Basic {encoded}"
+        """Get basic auth header for authentication (encoded once in __init__)"""
+        return self._basic_auth
     
     @retry_with_backoff
     def get_bearer_token(self, namespace, repository):
         """Get bearer token for specific repository operations"""
-        # Check if we have a cached token for this repository
-        cache_key = f"{namespace}/{repository}"
-        if cache_key in self.tokens:
-            token_data = self.tokens[cache_key]
-            # Simple cache - tokens typically last 5 minutes
-            if (datetime.now(timezone.utc) - token_data['created']).total_seconds() < 240:  # 4 minutes
-                self.log(f"  Using cached token for {cache_key}", "DEBUG")
-                return token_data['token']
-        
-        # Request new token
         scope = f"repository:{namespace}/{repository}:pull,push,delete"
-        url = f"{self.auth_url}/token"
-        params = {
-            "service": "registry.docker.io",
-            "scope": scope
-        }
         
-        headers = {
-            "Authorization": self.get_basic_auth_header()
-        }
-        
-        self.log(f"  Requesting bearer token for {namespace}/{repository}...", "DEBUG")
+        # Check if we have a cached token for this scope
+        with self._tokens_lock:
+            token_data = self.tokens.get(scope)
+            if not token_data:
+                fetch_lock = self._token_locks.get(scope)
+                if fetch_lock is None:
+                    fetch_lock = self._token_locks[scope] = threading.Lock()
+        if token_data:
+            self.log(f"  Using cached token for {namespace}/{repository}", "DEBUG")
+            return token_data['token']
         
-        try:
-            response = requests.get(url, params=params, headers=headers, timeout=self.request_timeout)
-            response.raise_for_status()
-            token = response.json().get("token")
+        with fetch_lock:
+            # Another worker may have fetched this token while we waited
+            with self._tokens_lock:
+                token_data = self.tokens.get(scope)
+            if token_data:
+                return token_data['token']
+            
+            # Request new token
+            url = f"{self.auth_url}/token"
+            params = {
+                "service": "registry.docker.io",
+                "scope": scope
+            }
             
-            # Cache the token
-            self.tokens[cache_key] = {
-                'token': token,
-                'created': datetime.now(timezone.utc)
+            headers = {
+                "Authorization": self.get_basic_auth_header()
             }
             
+            self.log(f"  Requesting bearer token for {namespace}/{repository}...", "DEBUG")
+            
+            # Failures propagate to retry_with_backoff, which retries or re-raises them
+            response = self.session.get(url, params=params, headers=headers, timeout=self.request_timeout)
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "")
+            if "application/json" not in content_type:
+                raise TokenResponseError(
+                    f"Unexpected token response Content-Type: {content_type or 'none'}", response=response
+                )
+            data = self.parse_json(response)
+            token = data.get("token")
+            
+            # Cache the token until shortly before the server says it expires
+            expires_in = data.get("expires_in", 300)
+            with self._tokens_lock:
+                self.tokens[scope] = {
+                    'token': token,
+                    'expires_at': time.monotonic() + expires_in - 30
+                }
+            
             self.log(f"  ✅ Got bearer token for {namespace}/{repository}", "DEBUG")
             return token
-            
-        except requests.exceptions.RequestException as e:
-            self.log(f"  Failed to get bearer token for {namespace}/{repository}: {e}", "DEBUG")
-            raise
     
     @retry_with_backoff
     def get_tags_registry(self, namespace, repository):
         """Get tags using Docker Registry API (more reliable)"""
-        tags = []
         token = self.get_bearer_token(namespace, repository)
         
         url = f"{self.registry_url}/{namespace}/{repository}/tags/list"
@@ -168,37 +352,29 @@ class DockerHubCleaner:
             "Accept": "application/json"
         }
         
-        try:
-            response = requests.get(url, headers=headers, timeout=self.request_timeout)
-            response.raise_for_status()
-            data = response.json()
-            
-            tag_names = data.get("tags", [])
-            if not tag_names:
-                return []
-            
-            self.log(f"  Found {len(tag_names)} tags, fetching details...", "DEBUG")
-            
-            for tag_name in tag_names:
-                # Registry API doesn't provide last_updated, use current time as fallback
-                tags.append({
-                    "name": tag_name,
-                    "last_updated": datetime.now(timezone.utc).isoformat()
-                })
-            
-            return tags
-            
-        except requests.exceptions.RequestException as e:
-            self.log(f"  Registry API failed, trying Hub API: {e}", "DEBUG")
-            # Fall back to Hub API
-            return self.get_tags_hub(namespace, repository)
+        self._rate_gate.wait()
+        response = self.session.get(url, headers=headers, timeout=self.request_timeout)
+        self._check_rate_limit(response)
+        response.raise_for_status()
+        data = self.parse_json(response)
+        
+        tag_names = data.get("tags", [])
+        if not tag_names:
+            return []
+        
+        self.log(f"  Found {len(tag_names)} tags", "DEBUG")
+        
+        # Registry API doesn't provide last_updated; it is looked up later, only for deletion candidates
+        return [{"name": tag_name, "last_updated": None} for tag_name in tag_names]
     
     @retry_with_backoff
-    def get_tags_hub(self, namespace, repository):
-        """Get tags using Docker Hub API (fallback)"""
-        tags = []
-        page = 1
-        page_size = 100
+    def get_tags_hub_page(self, namespace, repository, page, page_size=100):
+        """Get a single page of tags using Docker Hub API"""
+        url = f"{self.hub_url}/repositories/{namespace}/{repository}/tags"
+        params = {
+            "page": page,
+            "page_size": page_size
+        }
         
         # Docker Hub API doesn't require authentication for public repos
         # But we'll use basic auth if available
@@ -206,53 +382,185 @@ class DockerHubCleaner:
         if self.username and self.password:
             headers["Authorization"] = self.get_basic_auth_header()
         
-        while True:
-            url = f"{self.hub_url}/repositories/{namespace}/{repository}/tags"
-            params = {
-                "page": page,
-                "page_size": page_size
-            }
-            
-            self.log(f"📄 Fetching page {page} of tags for {namespace}/{repository}...", "DEBUG")
-            
-            try:
-                response = requests.get(
-                    url, 
-                    headers=headers, 
-                    params=params,
-                    timeout=self.request_timeout
-                )
-                response.raise_for_status()
-                data = response.json()
-                
-                if "results" not in data:
+        self.log(f"📄 Fetching page {page} of tags for {namespace}/{repository}...", "DEBUG")
+        
+        self._rate_gate.wait()
+        response = self.session.get(
+            url, 
+            headers=headers, 
+            params=params,
+            timeout=self.request_timeout
+        )
+        self._check_rate_limit(response)
+        response.raise_for_status()
+        return self.parse_json(response)
+    
+    def get_tags_hub(self, namespace, repository):
+        """Get tags using Docker Hub API (fallback)"""
+        page_size = 100
+        
+        try:
+            data = self.get_tags_hub_page(namespace, repository, 1, page_size)
+        except requests.exceptions.RequestException as e:
+            self.log(f"❌ Failed to get tags for {namespace}/{repository}: {e}", "ERROR")
+            return []
+        
+        if "results" not in data:
+            return []
+        
+        tags = list(data["results"])
+        self.log(f"  Found {len(data['results'])} tags on page 1", "DEBUG")
+        
+        if not data.get("next"):
+            return tags
+        
+        # The first page reports the total count, so the remaining pages can be fetched in parallel
+        count = data.get("count")
+        num_pages = math.ceil(count / page_size) if isinstance(count, int) else 0
+        if num_pages < 2:
+            # No usable count; follow the 'next' links one page at a time instead
+            self.log(f"  Tag count unavailable for {namespace}/{repository}, paging sequentially", "DEBUG")
+            page = 2
+            while True:
+                try:
+                    data = self.get_tags_hub_page(namespace, repository, page, page_size)
+                except requests.exceptions.RequestException as e:
+                    self.log(f"❌ Failed to get page {page} of tags for {namespace}/{repository}: {e}", "ERROR")
                     break
-                    
-                tags.extend(data["results"])
-                self.log(f"  Found {len(data['results'])} tags on page {page}", "DEBUG")
+                
+                results = data.get("results", [])
+                tags.extend(results)
+                self.log(f"  Found {len(results)} tags on page {page}", "DEBUG")
                 
                 if not data.get("next"):
                     break
-                    
-                page += 1
                 
-            except requests.exceptions.RequestException as e:
-                self.log(f"❌ Failed to get tags for {namespace}/{repository}: {e}", "ERROR")
+                page += 1
+            return tags
+        
+        pages = {}
+        with ThreadPoolExecutor(max_workers=min(4, num_pages - 1)) as pool:
+            futures = {
+                pool.submit(self.get_tags_hub_page, namespace, repository, page, page_size): page
+                for page in range(2, num_pages + 1)
+            }
+            for future in as_completed(futures):
+                page = futures[future]
+                try:
+                    results = future.result().get("results", [])
+                except requests.exceptions.RequestException as e:
+                    self.log(f"❌ Failed to get page {page} of tags for {namespace}/{repository}: {e}", "ERROR")
+                    continue
+                pages[page] = results
+                self.log(f"  Found {len(results)} tags on page {page}", "DEBUG")
+        
+        for page in sorted(pages):
+            tags.extend(pages[page])
+        
+        return tags
+    
+    @retry_with_backoff
+    def get_tag_created(self, namespace, repository, tag):
+        """
+        Get the image creation time of a tag from its config blob (Registry API).
+        This is the build time, not the push time; missing, unparseable and placeholder times are returned as None.
+        """
+        token = self.get_bearer_token(namespace, repository)
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept": self.manifest_accept
+        }
+        
+        reference = tag
+        for _ in range(2):
+            manifest_url = f"{self.registry_url}/{namespace}/{repository}/manifests/{reference}"
+            self._rate_gate.wait()
+            response = self.session.get(manifest_url, headers=headers, timeout=self.request_timeout)
+            self._check_rate_limit(response)
+            response.raise_for_status()
+            manifest = self.parse_json(response)
+            
+            # Multi-platform images point at per-platform manifests; any of them carries the build time
+            if not manifest.get("manifests"):
                 break
+            reference = manifest["manifests"][0]["digest"]
+        
+        config_digest = manifest.get("config", {}).get("digest")
+        if not config_digest:
+            return None
+        
+        blob_url = f"{self.registry_url}/{namespace}/{repository}/blobs/{config_digest}"
+        self._rate_gate.wait()
+        response = self.session.get(blob_url, headers={"Authorization": f"Bearer {token}"}, timeout=self.request_timeout)
+        self._check_rate_limit(response)
+        response.raise_for_status()
+        created = self.parse_json(response).get("created")
+        
+        # Only hand back times cleanup_repository can trust; None makes it keep the tag as undated
+        if not isinstance(created, str) or not created:
+            self.log(f"  No creation time in config for {tag}", "DEBUG")
+            return None
+        try:
+            parsed = self.parse_timestamp(created)
+        except (ValueError, TypeError):
+            self.log(f"  Unparseable creation time {created!r} for {tag}", "DEBUG")
+            return None
+        if parsed < EARLIEST_PLAUSIBLE_BUILD:
+            # Reproducible builds stamp a fixed time, which says nothing about the tag's age
+            self.log(f"  Ignoring placeholder creation time {created} for {tag}", "DEBUG")
+            return None
+        return created
+    
+    def _get_tag_created_bounded(self, namespace, repository, tag):
+        """Look up a tag's creation time while holding one of the shared per-tag slots"""
+        with self._tag_slots:
+            return self.get_tag_created(namespace, repository, tag)
+    
+    def fill_created_times(self, namespace, repository, tags):
+        """Look up creation times for undated tags that could be deleted, in parallel"""
+        candidates = [
+            tag for tag in tags
+            if tag.get("name") and tag.get("last_updated") is None
+            and self.classify_tag(tag["name"])[0] not in ("protected", "unknown")
+        ]
+        if not candidates:
+            return tags
+        
+        self.log(f"  Fetching creation times for {len(candidates)} candidate tags...", "DEBUG")
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(candidates))) as pool:
+            futures = {
+                pool.submit(self._get_tag_created_bounded, namespace, repository, tag["name"]): tag
+                for tag in candidates
+            }
+            for future in as_completed(futures):
+                tag = futures[future]
+                try:
+                    tag["last_updated"] = future.result()
+                except Exception as e:
+                    self.log(f"  Failed to get creation time for {tag['name']}: {e}", "DEBUG")
         
         return tags
     
     def get_tags(self, namespace, repository):
-        """Get all tags for a repository (tries both APIs)"""
-        # Try Hub API first (has better tag metadata)
-        tags = self.get_tags_hub(namespace, repository)
-        
-        # If Hub API fails, try Registry API
-        if not tags:
-            self.log(f"  Trying Registry API as fallback...", "DEBUG")
+        """Get all tags for a repository from the configured source"""
+        if self.source == "registry":
+            # One tags/list call plus config lookups for deletion candidates only.
+            # Failures propagate so the repository is reported as failed rather than empty.
             tags = self.get_tags_registry(namespace, repository)
+        else:
+            # Try Hub API first (has better tag metadata)
+            tags = self.get_tags_hub(namespace, repository)
+            
+            # If Hub API fails, try Registry API
+            if not tags and self.source == "auto":
+                self.log(f"  Trying Registry API as fallback...", "DEBUG")
+                try:
+                    tags = self.get_tags_registry(namespace, repository)
+                except requests.exceptions.RequestException as e:
+                    self.log(f"  Registry API failed as well: {e}", "DEBUG")
+                    tags = []
         
-        return tags
+        return self.fill_created_times(namespace, repository, tags)
     
     @retry_with_backoff
     def delete_tag(self, namespace, repository, tag):
@@ -265,14 +573,21 @@ class DockerHubCleaner:
         try:
             token = self.get_bearer_token(namespace, repository)
             
-            # First, get the manifest digest
+            # First, get the manifest digest (HEAD returns it without transferring the manifest body)
             manifest_url = f"{self.registry_url}/{namespace}/{repository}/manifests/{tag}"
             headers = {
                 "Authorization": f"Bearer {token}",
-                "Accept": "application/vnd.docker.distribution.manifest.v2+json"
+                "Accept": self.manifest_accept
             }
             
-            response = requests.get(manifest_url, headers=headers, timeout=self.request_timeout)
+            self._rate_gate.wait()
+            response = self.session.head(manifest_url, headers=headers, timeout=self.request_timeout, allow_redirects=True)
+            self._check_rate_limit(response)
+            if response.status_code == HTTPStatus.METHOD_NOT_ALLOWED:
+                # Some registries don't support HEAD on manifests
+                self._rate_gate.wait()
+                response = self.session.get(manifest_url, headers=headers, timeout=self.request_timeout)
+                self._check_rate_limit(response)
             response.raise_for_status()
             
             # Get the digest from headers
@@ -282,7 +597,9 @@ class DockerHubCleaner:
             
             # Now delete by digest
             delete_url = f"{self.registry_url}/{namespace}/{repository}/manifests/{digest}"
-            response = requests.delete(delete_url, headers=headers, timeout=self.request_timeout)
+            self._rate_gate.wait()
+            response = self.session.delete(delete_url, headers=headers, timeout=self.request_timeout)
+            self._check_rate_limit(response)
             response.raise_for_status()
             
             self.log(f"  ✅ Deleted: {namespace}/{repository}:{tag}")
@@ -301,7 +618,9 @@ class DockerHubCleaner:
                 if self.username and self.password:
                     headers["Authorization"] = self.get_basic_auth_header()
                 
-                response = requests.delete(url, headers=headers, timeout=self.request_timeout)
+                self._rate_gate.wait()
+                response = self.session.delete(url, headers=headers, timeout=self.request_timeout)
+                self._check_rate_limit(response)
                 response.raise_for_status()
                 self.log(f"  ✅ Deleted via Hub API: {namespace}/{repository}:{tag}")
                 return True
@@ -310,6 +629,11 @@ class DockerHubCleaner:
                 self.log(f"  ❌ Failed to delete {namespace}/{repository}:{tag}: {e2}", "ERROR")
                 return False
     
+    def _delete_tag_bounded(self, namespace, repository, tag):
+        """Delete a tag while holding one of the shared per-tag slots"""
+        with self._tag_slots:
+            return self.delete_tag(namespace, repository, tag)
+    
     def test_authentication(self):
         """Test if authentication works"""
         self.log("🔐 Testing authentication...")
@@ -318,8 +642,8 @@ class DockerHubCleaner:
         try:
             url = f"{self.hub_url}/users/{self.username}"
             headers = {"Authorization": self.get_basic_auth_header()}
-            response = requests.get(url, headers=headers, timeout=self.request_timeout)
-            if response.status_code == 200:
+            response = self.session.get(url, headers=headers, timeout=self.request_timeout)
+            if response.status_code == HTTPStatus.OK:
                 self.log("✅ Authentication successful")
                 return True
         except Exception as e:
@@ -330,44 +654,62 @@ class DockerHubCleaner:
         self.log("   Password can be either your Docker Hub password or a Personal Access Token", "ERROR")
         return False
     
-    def is_protected_tag(self, tag_name):
-        """Check if a tag is protected from deletion"""
-        # Built-in protected patterns
-        protected_pattern = re.compile(r'^(latest|main|master|develop|\d+\.\d+\.\d+|v\d+\.\d+\.\d+|\d+\.\d+|\d+)$')
-        
-        # Check built-in patterns
-        if protected_pattern.match(tag_name):
-            return True
-        
+    def classify_tag(self, tag_name):
+        """
+        Classify a tag name as 'protected', 'custom', 'pr', 'sha' or 'unknown'.
+        Returns (tag_type, cutoff); cutoff is only set for custom patterns.
+        """
         # Check custom protected tags
         if tag_name in self.protected_tags:
-            return True
+            return "protected", None
         
-        return False
+        match = self._classifier.match(tag_name)
+        if match and match.lastgroup == "protected":
+            return "protected", None
+        
+        # Custom patterns take precedence over the built-in PR/SHA patterns
+        for pattern, cutoff in self._custom_cutoffs:
+            if pattern.match(tag_name):
+                return "custom", cutoff
+        
+        if match:
+            return match.lastgroup, None
+        
+        return "unknown", None
     
-    def should_delete_tag(self, tag_name, last_updated, pr_cutoff, sha_cutoff):
+    def is_protected_tag(self, tag_name):
+        """Check if a tag is protected from deletion"""
+        return self.classify_tag(tag_name)[0] == "protected"
+    
+    def should_delete_tag(self, tag_name, last_updated, pr_cutoff, sha_cutoff, classification=None):
         """Determine if a tag should be deleted based on patterns and age"""
-        # Patterns for different tag types
-        pr_pattern = re.compile(r'^pr-\d+$')
-        sha_pattern = re.compile(r'^(main|master|develop)-[a-f0-9]{7,}$')
+        tag_type, custom_cutoff = classification or self.classify_tag(tag_name)
         
-        # Check custom patterns first
-        for pattern_str, retention_days in self.custom_patterns.items():
-            pattern = re.compile(pattern_str)
-            if pattern.match(tag_name):
-                cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
-                return last_updated < cutoff, "custom"
+        if tag_type == "custom":
+            return last_updated < custom_cutoff, "custom"
         
-        # Check PR tags
-        if pr_pattern.match(tag_name):
+        if tag_type == "pr":
             return last_updated < pr_cutoff, "pr"
         
-        # Check SHA tags
-        if sha_pattern.match(tag_name):
+        if tag_type == "sha":
             return last_updated < sha_cutoff, "sha"
         
-        # Unknown format - don't delete
-        return False, "unknown"
+        # Protected or unknown format - don't delete
+        return False, tag_type
+    
+    def record_repository(self, repo_stats):
+        """Stream repository stats as a JSON line if a stream is set, and keep them for the summary if needed"""
+        with self._stats_lock:
+            if self.keep_repository_stats:
+                self.stats["repositories"].append(repo_stats)
+            if self.stream is None:
+                return
+            if orjson is not None:
+                line = orjson.dumps(repo_stats) + b"\n"
+            else:
+                line = (json.dumps(repo_stats) + "\n").encode()
+            self.stream.write(line)
+            self.stream.flush()
     
     def cleanup_repository(self, repo_spec, default_namespace=None, pr_retention_days=30, sha_retention_days=14):
         """
@@ -389,7 +731,7 @@ class DockerHubCleaner:
         
         tags = self.get_tags(namespace, repository)
         if not tags:
-            self.log(f"  ℹ️  No tags found")
+            self.log(f"  ℹ️  No tags found for {namespace}/{repository}")
             repo_stats = {
                 "repository": f"{namespace}/{repository}",
                 "total_tags": 0,
@@ -399,10 +741,10 @@ class DockerHubCleaner:
                 "failed": 0,
                 "identified": 0
             }
-            self.stats["repositories"].append(repo_stats)
+            self.record_repository(repo_stats)
             return repo_stats
         
-        self.log(f"  📊 Found {len(tags)} total tags")
+        self.log(f"  📊 Found {len(tags)} total tags in {namespace}/{repository}")
         
         # Calculate cutoff dates
         now = datetime.now(timezone.utc)
@@ -414,64 +756,99 @@ class DockerHubCleaner:
         kept_count = 0
         failed_count = 0
         identified_count = 0
+        to_delete = []
         
         for tag in tags:
             tag_name = tag.get("name")
             if not tag_name:
                 continue
             
+            classification = self.classify_tag(tag_name)
+            tag_type = classification[0]
+            
+            # Check if tag is protected (its date is never needed)
+            if tag_type == "protected":
+                self.log(f"  🛡️  Protected: {namespace}/{repository}:{tag_name}")
+                protected_count += 1
+                with self._stats_lock:
+                    self.stats["protected_count"] += 1
+                continue
+            
+            # Tags that match no deletion pattern are kept regardless of age
+            if tag_type == "unknown":
+                self.log(f"  ❓ Keeping unknown format: {namespace}/{repository}:{tag_name}")
+                kept_count += 1
+                continue
+            
             # Parse last updated date
             last_updated_str = tag.get("last_updated", "")
+            if last_updated_str is None:
+                # Registry API listings carry no dates and the creation time lookup failed
+                self.log(f"  ⚠️  Skipping {namespace}/{repository}:{tag_name}: unable to determine age", "WARNING")
+                kept_count += 1
+                continue
             try:
                 # Handle both ISO format and simple datetime
                 if last_updated_str:
-                    # Docker Hub dates end with 'Z' for UTC
-                    last_updated = datetime.strptime(
-                        last_updated_str[:19], 
-                        "%Y-%m-%dT%H:%M:%S"
-                    ).replace(tzinfo=timezone.utc)
+                    last_updated = self.parse_timestamp(last_updated_str)
                 else:
                     # If no date, assume it's old enough to consider
                     last_updated = datetime.now(timezone.utc) - timedelta(days=365)
             except (ValueError, TypeError):
-                self.log(f"  ⚠️  Skipping {tag_name}: unable to parse date", "WARNING")
+                self.log(f"  ⚠️  Skipping {namespace}/{repository}:{tag_name}: unable to parse date", "WARNING")
                 kept_count += 1
                 continue
             
-            # Check if tag is protected
-            if self.is_protected_tag(tag_name):
-                self.log(f"  🛡️  Protected: {tag_name}")
-                protected_count += 1
-                self.stats["protected_count"] += 1
-                continue
-            
             # Check if tag should be deleted
-            should_delete, tag_type = self.should_delete_tag(tag_name, last_updated, pr_cutoff, sha_cutoff)
+            should_delete, tag_type = self.should_delete_tag(tag_name, last_updated, pr_cutoff, sha_cutoff, classification)
             
             if should_delete:
                 identified_count += 1
-                self.stats["identified_count"] += 1
-                
-                if self.delete_tag(namespace, repository, tag_name):
-                    deleted_count += 1
-                    self.stats["deleted_count"] += 1
-                else:
-                    failed_count += 1
+                with self._stats_lock:
+                    self.stats["identified_count"] += 1
+                to_delete.append(tag_name)
             else:
-                if tag_type != "unknown":
-                    self.log(f"  ⏳ Keeping {tag_type} tag (recent): {tag_name}")
-                else:
-                    self.log(f"  ❓ Keeping unknown format: {tag_name}")
+                self.log(f"  ⏳ Keeping {tag_type} tag (recent): {namespace}/{repository}:{tag_name}")
                 kept_count += 1
         
-        # Summary
-        self.log(f"\n  📈 Summary for {namespace}/{repository}:")
-        self.log(f"     Protected: {protected_count}")
-        self.log(f"     Identified: {identified_count}")
-        self.log(f"     Deleted: {deleted_count}")
-        self.log(f"     Kept: {kept_count}")
+        if to_delete and self.dry_run:
+            # Nothing to send to the registry; report the whole batch in one log line
+            self.log(f"  🔍 [DRY RUN] Would delete {len(to_delete)} tags from {namespace}/{repository}: {', '.join(to_delete)}")
+            deleted_count = len(to_delete)
+            with self._stats_lock:
+                self.stats["deleted_count"] += deleted_count
+        # Deletions are network-bound, so run them concurrently
+        elif to_delete:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(to_delete))) as pool:
+                futures = {
+                    pool.submit(self._delete_tag_bounded, namespace, repository, tag_name): tag_name
+                    for tag_name in to_delete
+                }
+                for future in as_completed(futures):
+                    try:
+                        deleted = future.result()
+                    except Exception as e:
+                        self.log(f"  ❌ Failed to delete {namespace}/{repository}:{futures[future]}: {e}", "ERROR")
+                        deleted = False
+                    
+                    if deleted:
+                        deleted_count += 1
+                        with self._stats_lock:
+                            self.stats["deleted_count"] += 1
+                    else:
+                        failed_count += 1
+        
+        # Summary, logged in one call so other repositories' output can't interleave with it
+        summary = (
+            f"\n  📈 Summary for {namespace}/{repository}:"
+            f"\n     Protected: {protected_count}"
+            f"\n     Identified: {identified_count}"
+            f"\n     Deleted: {deleted_count}"
+            f"\n     Kept: {kept_count}"
+        )
         if failed_count > 0:
-            self.log(f"     Failed: {failed_count}", "WARNING")
+            summary += f"\n     Failed: {failed_count}"
+        self.log(summary, "WARNING" if failed_count > 0 else "INFO")
         
         repo_stats = {
             "repository": f"{namespace}/{repository}",
@@ -483,7 +860,7 @@ class DockerHubCleaner:
             "identified": identified_count
         }
         
-        self.stats["repositories"].append(repo_stats)
+        self.record_repository(repo_stats)
         return repo_stats
 
 
@@ -497,6 +874,12 @@ def main():
     parser.add_argument("--output-json", action="store_true", help="Output JSON summary to stdout")
     parser.add_argument("--protected-tags", nargs="*", help="Additional tags to protect from deletion")
     parser.add_argument("--custom-patterns", type=str, help="JSON string of custom patterns and retention days")
+    parser.add_argument("--source", choices=["auto", "hub", "registry"], default="auto",
+                        help="Where to list tags from: Hub API with Registry fallback (auto), Hub API only, or Registry API only "
+                             "(default: auto). Registry listings measure tag age from the image build time, not the push time")
+    parser.add_argument("--stream-json", metavar="PATH",
+                        help="Write per-repository results as JSON lines to PATH ('-' for stdout) as they complete")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum parallel tag deletions and creation time lookups (default: 8)")
     
     args = parser.parse_args()
     
@@ -523,65 +906,110 @@ def main():
             print(f"❌ Error: Invalid JSON for custom patterns: {e}", file=sys.stderr)
             sys.exit(2)
     
-    # Get protected tags from environment if set
-    protected_tags = args.protected_tags or []
+    # Get protected tags from arguments and environment, ignoring whitespace and duplicates
     env_protected = os.environ.get("PROTECTED_TAGS", "")
-    if env_protected:
-        protected_tags.extend(env_protected.split(","))
+    protected_tags = {tag.strip() for tag in (args.protected_tags or []) if tag.strip()}
+    protected_tags |= {tag.strip() for tag in env_protected.split(",") if tag.strip()}
+    
+    # Open the per-repository results stream if requested
+    stream = None
+    if args.stream_json == "-":
+        if args.output_json:
+            print("❌ Error: --stream-json - cannot be combined with --output-json (both write to stdout)", file=sys.stderr)
+            sys.exit(2)
+        stream = sys.stdout.buffer
+    elif args.stream_json:
+        try:
+            stream = open(args.stream_json, "wb")
+        except OSError as e:
+            print(f"❌ Error: Unable to open stream file {args.stream_json}: {e}", file=sys.stderr)
+            sys.exit(2)
     
     # Initialize cleaner
-    cleaner = DockerHubCleaner(
-        username, 
-        password, 
-        args.dry_run, 
-        args.verbose,
-        protected_tags,
-        custom_patterns
-    )
+    try:
+        cleaner = DockerHubCleaner(
+            username, 
+            password, 
+            args.dry_run, 
+            args.verbose,
+            protected_tags,
+            custom_patterns,
+            args.concurrency,
+            args.source,
+            stream,
+            # The JSON summary lists every repository; otherwise streaming replaces that list
+            keep_repository_stats=args.output_json or stream is None
+        )
+    except re.error as e:
+        print(f"❌ Error: Invalid regular expression in custom patterns: {e}", file=sys.stderr)
+        sys.exit(2)
+    except TypeError as e:
+        print(f"❌ Error: Custom pattern retention must be a number of days: {e}", file=sys.stderr)
+        sys.exit(2)
     
     # Test authentication
     if not cleaner.test_authentication():
         sys.exit(2)  # Exit code 2 for authentication failure
     
-    # Process each repository
-    results = []
+    # Process repositories concurrently; each one talks to Docker Hub independently.
+    # Only running totals are kept here so memory does not grow with the number of repositories.
+    totals = {"processed": 0, "identified": 0, "deleted": 0, "kept": 0, "protected": 0, "failed": 0}
     failed_repos = []
+    repo_order = {}  # Repository name -> position requested, to sort the kept per-repository stats
     
-    for repo_spec in args.repositories:
-        try:
-            result = cleaner.cleanup_repository(
+    with ThreadPoolExecutor(max_workers=min(8, len(args.repositories))) as pool:
+        futures = {
+            pool.submit(
+                cleaner.cleanup_repository,
                 repo_spec,
                 namespace,  # Use as default namespace for unqualified repos 
                 args.pr_retention,
                 args.sha_retention
-            )
-            if result:
-                results.append(result)
-                
-                # Track repositories with failures
-                if result.get("failed", 0) > 0:
-                    failed_repos.append(result["repository"])
-            else:
-                failed_repos.append(repo_spec)
-                
-        except Exception as e:
-            cleaner.log(f"❌ Failed to process {repo_spec}: {e}", "ERROR")
-            failed_repos.append(repo_spec)
-            # Add a failure result for this repository
-            results.append({
-                "repository": repo_spec,
-                "total_tags": 0,
-                "protected": 0,
-                "deleted": 0,
-                "kept": 0,
-                "failed": -1,  # -1 indicates complete failure
-                "identified": 0
-            })
+            ): index
+            for index, repo_spec in enumerate(args.repositories)
+        }
+        for future in as_completed(futures):
+            # Drop the future once handled so its result can be freed
+            index = futures.pop(future)
+            repo_spec = args.repositories[index]
+            try:
+                result = future.result()
+            except Exception as e:
+                cleaner.log(f"❌ Failed to process {repo_spec}: {e}", "ERROR")
+                totals["processed"] += 1
+                failed_repos.append((index, repo_spec))
+                continue
+            
+            if not result:
+                failed_repos.append((index, repo_spec))
+                continue
+            
+            totals["processed"] += 1
+            if cleaner.keep_repository_stats:
+                repo_order.setdefault(result["repository"], index)
+            for key in ("identified", "deleted", "kept", "protected"):
+                totals[key] += result.get(key, 0)
+            
+            # Track repositories with failures
+            if result.get("failed", 0) > 0:
+                totals["failed"] += result["failed"]
+                failed_repos.append((index, result["repository"]))
+    
+    # Report failures and per-repository stats in the order repositories were requested
+    failed_repos = [repo for _, repo in sorted(failed_repos)]
+    cleaner.stats["repositories"].sort(key=lambda repo_stats: repo_order.get(repo_stats["repository"], len(args.repositories)))
+    
+    if stream is not None and stream is not sys.stdout.buffer:
+        stream.close()
     
     # Output JSON if requested
     if args.output_json:
         # Output clean JSON to stdout for the action to parse
-        json.dump(cleaner.stats, sys.stdout, indent=2)
+        if orjson is not None:
+            sys.stdout.buffer.write(orjson.dumps(cleaner.stats, option=orjson.OPT_INDENT_2))
+            sys.stdout.flush()
+        else:
+            json.dump(cleaner.stats, sys.stdout, indent=2)
     else:
         # Print human-readable summary to stderr
         print("\n" + "="*60, file=sys.stderr)
@@ -591,15 +1019,14 @@ def main():
         if args.dry_run:
             print("ℹ️  This was a DRY RUN - no tags were actually deleted", file=sys.stderr)
         
-        # Calculate totals
-        total_deleted = sum(r.get("deleted", 0) for r in results)
-        total_kept = sum(r.get("kept", 0) for r in results)
-        total_protected = sum(r.get("protected", 0) for r in results)
-        total_failed = sum(r.get("failed", 0) for r in results if r.get("failed", 0) > 0)
-        total_identified = sum(r.get("identified", 0) for r in results)
+        total_deleted = totals["deleted"]
+        total_kept = totals["kept"]
+        total_protected = totals["protected"]
+        total_failed = totals["failed"]
+        total_identified = totals["identified"]
         
         print(f"\n📊 Overall Statistics:", file=sys.stderr)
-        print(f"   Repositories processed: {len(results)}", file=sys.stderr)
+        print(f"   Repositories processed: {totals['processed']}", file=sys.stderr)
         print(f"   Tags identified: {total_identified}", file=sys.stderr)
         print(f"   Tags deleted: {total_deleted}", file=sys.stderr)
         print(f"   Tags kept: {total_kept}", file=sys.stderr)
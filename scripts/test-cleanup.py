@@ -4,21 +4,75 @@ Test script for Docker Hub Cleanup
 Tests the logic without making actual API calls
 """
 
+import importlib.util
+import json
+import os
 import re
+import time
 from datetime import datetime, timedelta, timezone
 
 
+def load_cleanup_module():
+    """Load dockerhub-cleanup.py, whose hyphenated name can't be imported normally"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dockerhub-cleanup.py")
+    spec = importlib.util.spec_from_file_location("dockerhub_cleanup", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+cleanup = load_cleanup_module()
+
+
+class FakeResponse:
+    """Minimal stand-in for requests.Response"""
+    
+    def __init__(self, data=None, headers=None, status_code=200):
+        self.content = json.dumps(data).encode()
+        self.headers = headers or {}
+        self.status_code = status_code
+    
+    def json(self):
+        return json.loads(self.content)
+    
+    def raise_for_status(self):
+        pass
+
+
+class FakeRegistrySession:
+    """Answers Registry API calls from a dict of tag name -> config 'created' value"""
+    
+    def __init__(self, created_by_tag):
+        self.created_by_tag = created_by_tag
+    
+    def get(self, url, **kwargs):
+        if url.endswith("/tags/list"):
+            return FakeResponse({"tags": list(self.created_by_tag)})
+        if "/manifests/" in url:
+            tag = url.rsplit("/", 1)[1]
+            return FakeResponse({"config": {"digest": f"sha256:{tag}"}})
+        if "/blobs/sha256:" in url:
+            tag = url.rsplit(":", 1)[1]
+            return FakeResponse({"created": self.created_by_tag[tag]})
+        raise AssertionError(f"Unexpected request: {url}")
+
+
+def registry_cleaner(created_by_tag, **kwargs):
+    """Build a cleaner that lists tags from a FakeRegistrySession, with a cached token so no auth call is made"""
+    cleaner = cleanup.DockerHubCleaner("test-user", "test-password", source="registry", **kwargs)
+    cleaner.session = FakeRegistrySession(created_by_tag)
+    cleaner.tokens["repository:ns/repo:pull,push,delete"] = {"token": "t", "expires_at": time.monotonic() + 300}
+    return cleaner
+
+
 def test_patterns():
     """Test regex patterns for tag matching"""
     
-    # Patterns from the cleanup script
-    pr_pattern = re.compile(r'^pr-\d+$')
-    sha_pattern = re.compile(r'^(main|master|develop)-[a-f0-9]{7,}$')
-    protected_pattern = re.compile(r'^(latest|main|master|develop|\d+\.\d+\.\d+|v\d+\.\d+\.\d+|\d+\.\d+|\d+)$')
+    cleaner = cleanup.DockerHubCleaner("test-user", "test-password")
     
     # Test cases
     test_cases = [
-        # Tag name, Expected result (pr/sha/protected/none)
+        # Tag name, Expected result (pr/sha/protected/unknown)
         ("pr-123", "pr"),
         ("pr-456789", "pr"),
         ("main-abc123f", "sha"),
@@ -33,14 +87,14 @@ def test_patterns():
         ("1.0", "protected"),
         ("1", "protected"),
         ("2", "protected"),
-        ("feature-branch", "none"),
-        ("pr-abc", "none"),  # Invalid PR format
-        ("main-xyz", "none"),  # Invalid SHA (not hex)
-        ("main-12345", "none"),  # Invalid SHA (not hex)
-        ("v1", "none"),  # v1 without dots is not protected
-        ("1.0.0.0", "none"),  # Too many version parts
-        ("latest-l11", "none"),  # Not a protected pattern
-        ("latest-v2", "none"),  # Similar variant, not protected
+        ("feature-branch", "unknown"),
+        ("pr-abc", "unknown"),  # Invalid PR format
+        ("main-xyz", "unknown"),  # Invalid SHA (not hex)
+        ("main-12345", "unknown"),  # Invalid SHA (not hex)
+        ("v1", "unknown"),  # v1 without dots is not protected
+        ("1.0.0.0", "unknown"),  # Too many version parts
+        ("latest-l11", "unknown"),  # Not a protected pattern
+        ("latest-v2", "unknown"),  # Similar variant, not protected
     ]
     
     print("Testing tag patterns...")
@@ -50,14 +104,7 @@ def test_patterns():
     failed = 0
     
     for tag_name, expected in test_cases:
-        if pr_pattern.match(tag_name):
-            result = "pr"
-        elif sha_pattern.match(tag_name):
-            result = "sha"
-        elif protected_pattern.match(tag_name):
-            result = "protected"
-        else:
-            result = "none"
+        result, _ = cleaner.classify_tag(tag_name)
         
         status = "✅" if result == expected else "❌"
         if result == expected:
@@ -72,41 +119,361 @@ def test_patterns():
     return failed == 0
 
 
+def test_classification_precedence():
+    """Test precedence: protected tags > built-in protected > custom patterns > PR/SHA"""
+    
+    print("\nTesting classification precedence...")
+    print("-" * 60)
+    
+    cleaner = cleanup.DockerHubCleaner(
+        "test-user",
+        "test-password",
+        protected_tags={"pr-1", "staging"},
+        custom_patterns={"^pr-9": 5, "^lat": 1, "^main-": 2}
+    )
+    
+    test_cases = [
+        # (tag_name, expected_type)
+        ("pr-1", "protected"),  # Protected tag wins over PR pattern
+        ("staging", "protected"),  # Protected tag with no other match
+        ("latest", "protected"),  # Built-in protected wins over custom '^lat'
+        ("pr-99", "custom"),  # Custom wins over PR pattern
+        ("main-abcdef1", "custom"),  # Custom wins over SHA pattern
+        ("pr-2", "pr"),  # Not covered by custom patterns
+        ("develop-abcdef1", "sha"),  # Not covered by custom patterns
+        ("feature-x", "unknown"),
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for tag_name, expected in test_cases:
+        result, cutoff = cleaner.classify_tag(tag_name)
+        # Only custom patterns carry their own cutoff
+        ok = result == expected and (cutoff is not None) == (expected == "custom")
+        
+        status = "✅" if ok else "❌"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+            
+        print(f"{status} Tag: {tag_name:20} Expected: {expected:10} Got: {result:10}")
+    
+    print("-" * 60)
+    print(f"Results: {passed} passed, {failed} failed")
+    return failed == 0
+
+
 def test_date_parsing():
     """Test date parsing logic"""
     
     print("\nTesting date parsing...")
     print("-" * 60)
     
+    cleaner = cleanup.DockerHubCleaner("test-user", "test-password")
+    expected_utc = datetime(2024, 1, 15, 10, 30, 45, tzinfo=timezone.utc)
+    
     test_dates = [
-        ("2024-01-15T10:30:45.123456Z", True),
-        ("2024-01-15T10:30:45", True),
-        ("2024-01-15T10:30:45Z", True),
-        ("invalid-date", False),
-        ("", False),
-        (None, False),
+        # (date_str, expected UTC datetime, a tuple of accepted ones, or None if it shouldn't parse)
+        ("2024-01-15T10:30:45.123456Z", expected_utc.replace(microsecond=123456)),
+        ("2024-01-15T10:30:45", expected_utc),  # Naive dates are treated as UTC
+        ("2024-01-15T10:30:45Z", expected_utc),
+        # Registry config blobs use nanoseconds; only Python 3.11+ keeps the fraction, older ones fall back to seconds
+        ("2024-01-15T10:30:45.123456789Z", (expected_utc.replace(microsecond=123456), expected_utc)),
+        ("2024-01-15T12:30:45+02:00", expected_utc),  # Offsets are respected
+        ("invalid-date", None),
+        ("", None),
+        (None, None),
     ]
     
     passed = 0
     failed = 0
     
-    for date_str, should_parse in test_dates:
+    for date_str, expected in test_dates:
         try:
-            if date_str:
-                parsed = datetime.strptime(date_str[:19], "%Y-%m-%dT%H:%M:%S")
-                result = True
-            else:
-                result = False
+            # cleanup_repository only parses non-empty dates
+            result = cleaner.parse_timestamp(date_str) if date_str else None
         except (ValueError, TypeError):
-            result = False
+            result = None
+        
+        accepted = expected if isinstance(expected, tuple) else (expected,)
+        ok = result in accepted and (result is None or result.tzinfo is not None)
+        status = "✅" if ok else "❌"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+            
+        print(f"{status} Date: {str(date_str):30} Expected: {' or '.join(map(str, accepted)):32} Got: {result}")
+    
+    print("-" * 60)
+    print(f"Results: {passed} passed, {failed} failed")
+    return failed == 0
+
+
+def test_retry_after_parsing():
+    """Test Retry-After header parsing (delay-seconds and HTTP-date)"""
+    from email.utils import format_datetime
+    
+    print("\nTesting Retry-After parsing...")
+    print("-" * 60)
+    
+    cleaner = cleanup.DockerHubCleaner("test-user", "test-password")
+    future = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=120), usegmt=True)
+    
+    test_cases = [
+        # (header value, expected seconds or None, tolerance)
+        ("5", 5.0, 0),
+        ("0", 0.0, 0),
+        ("-3", 0.0, 0),  # Negative delays are clamped
+        ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0, 0),  # Dates in the past mean retry now
+        (future, 120.0, 5),
+        ("soon", None, 0),
+        ("", None, 0),
+        (None, None, 0),
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for value, expected, tolerance in test_cases:
+        result = cleaner.parse_retry_after(value)
+        if expected is None or result is None:
+            ok = result == expected
+        else:
+            ok = abs(result - expected) <= tolerance
+        
+        status = "✅" if ok else "❌"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+            
+        print(f"{status} Retry-After: {str(value):32} Expected: {str(expected):6} Got: {result}")
+    
+    print("-" * 60)
+    print(f"Results: {passed} passed, {failed} failed")
+    return failed == 0
+
+
+def test_invalid_response_retries():
+    """Test that a non-JSON token response fails at once while malformed JSON bodies are retried"""
+    
+    print("\nTesting retries of invalid responses...")
+    print("-" * 60)
+    
+    class CountingSession:
+        """Returns the same HTML page for every request, counting calls"""
+        
+        def __init__(self):
+            self.calls = 0
+        
+        def get(self, url, **kwargs):
+            self.calls += 1
+            response = FakeResponse(headers={"Content-Type": "text/html"})
+            response.content = b"<html>Gateway</html>"
+            return response
+    
+    test_cases = [
+        # (description, call, expected exception, expected request count)
+        ("Token Content-Type guard", lambda c: c.get_bearer_token("ns", "repo"), cleanup.TokenResponseError, 1),
+        ("Malformed tag list JSON", lambda c: c.get_tags_hub_page("ns", "repo", 1), cleanup.requests.exceptions.JSONDecodeError, 3),
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for description, call, expected_error, expected_calls in test_cases:
+        cleaner = cleanup.DockerHubCleaner("test-user", "test-password")
+        cleaner.retry_delay = 0
+        cleaner.log = lambda message, level="INFO": None
+        cleaner.session = CountingSession()
+        try:
+            call(cleaner)
+            error = None
+        except Exception as e:
+            error = e
+        
+        ok = isinstance(error, expected_error) and cleaner.session.calls == expected_calls
+        status = "✅" if ok else "❌"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+            
+        print(f"{status} {description:28} Expected: {expected_error.__name__} after {expected_calls} Got: {type(error).__name__} after {cleaner.session.calls}")
+    
+    print("-" * 60)
+    print(f"Results: {passed} passed, {failed} failed")
+    return failed == 0
+
+
+def test_rate_limit_headers():
+    """Test rate-limit header parsing for proactive throttling (Registry and Hub API formats)"""
+    
+    print("\nTesting rate-limit headers...")
+    print("-" * 60)
+    
+    test_cases = [
+        # (headers, max wait, expected pause in seconds or None if no pause, tolerance)
+        ({}, 0.5, None, 0),  # No rate-limit headers
+        ({"ratelimit-remaining": "76;w=21600"}, 0.5, None, 0),  # Plenty left
+        ({"ratelimit-remaining": "unknown"}, 0.5, None, 0),  # Unparseable
+        ({"ratelimit-remaining": "2;w=21600", "ratelimit-reset": "0.2;w=21600"}, 0.5, 0.2, 0),
+        ({"x-ratelimit-remaining": "2", "x-ratelimit-reset": "0.2"}, 0.5, 0.2, 0),
+        # Unix timestamps are built when the case runs, since earlier cases pause
+        (lambda: {"x-ratelimit-remaining": "2", "x-ratelimit-reset": str(time.time() + 0.3)}, 0.5, 0.3, 0.1),
+        ({"ratelimit-remaining": "2"}, 1.5, 1.0, 0),  # Missing reset falls back to 1 second
+        ({"ratelimit-remaining": "2", "ratelimit-reset": "soon"}, 1.5, 1.0, 0),  # Unparseable reset
+        ({"ratelimit-remaining": "0", "ratelimit-reset": "3600"}, 0.2, 0.2, 0),  # Clamped to max wait
+        ({"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(time.time() + 3600)}, 0.2, 0.2, 0),  # Clamped timestamp
+        ({"ratelimit-remaining": "1", "ratelimit-reset": "-5"}, 0.5, 0.0, 0),  # Resets in the past don't pause
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for headers, max_wait, expected, tolerance in test_cases:
+        cleaner = cleanup.DockerHubCleaner("test-user", "test-password")
+        cleaner.max_rate_limit_wait = max_wait
+        messages = []
+        cleaner.log = lambda message, level="INFO": messages.append(message)
+        
+        if callable(headers):
+            headers = headers()
+        cleaner._check_rate_limit(FakeResponse(headers=headers))
+        pauses = [float(m.group(1)) for m in map(re.compile(r"pausing ([\d.]+) seconds").search, messages) if m]
+        result = pauses[0] if pauses else None
+        
+        if expected is None or result is None:
+            ok = result == expected
+        else:
+            # The logged wait is rounded to one decimal
+            ok = abs(result - expected) <= tolerance + 0.05
+        ok = ok and cleaner._rate_gate.is_set()  # Workers are released after the pause
+        
+        status = "✅" if ok else "❌"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+            
+        print(f"{status} Headers: {str(headers)[:60]:60} Expected: {str(expected):5} Got: {result}")
+    
+    print("-" * 60)
+    print(f"Results: {passed} passed, {failed} failed")
+    return failed == 0
+
+
+def test_tag_created_validation():
+    """Test that only plausible, parseable creation times are trusted"""
+    
+    print("\nTesting creation time validation...")
+    print("-" * 60)
+    
+    old = (datetime.now(timezone.utc) - timedelta(days=90)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    created_by_tag = {
+        "pr-1": old,
+        "pr-2": "",  # Empty string
+        "pr-3": 1700000000,  # Not a string
+        "pr-4": "1970-01-01T00:00:00Z",  # Reproducible build placeholder
+        "pr-5": "yesterday",  # Unparseable
+        "pr-6": None,  # Missing
+    }
+    cleaner = registry_cleaner(created_by_tag, dry_run=True)
+    
+    test_cases = [
+        # (tag_name, expected creation time)
+        ("pr-1", old),
+        ("pr-2", None),
+        ("pr-3", None),
+        ("pr-4", None),
+        ("pr-5", None),
+        ("pr-6", None),
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for tag_name, expected in test_cases:
+        try:
+            result = cleaner.get_tag_created("ns", "repo", tag_name)
+        except Exception as e:
+            result = e
         
-        status = "✅" if result == should_parse else "❌"
-        if result == should_parse:
+        status = "✅" if result == expected else "❌"
+        if result == expected:
+            passed += 1
+        else:
+            failed += 1
+            
+        print(f"{status} Tag: {tag_name:8} created: {str(created_by_tag[tag_name]):30} Expected: {str(expected):30} Got: {result}")
+    
+    # Tags without a trusted time must be kept, not treated as old
+    stats = cleaner.cleanup_repository("ns/repo", pr_retention_days=30)
+    ok = stats["identified"] == 1 and stats["kept"] == 5
+    status = "✅" if ok else "❌"
+    if ok:
+        passed += 1
+    else:
+        failed += 1
+    print(f"{status} Registry cleanup identifies only pr-1 Got: identified={stats['identified']} kept={stats['kept']}")
+    
+    print("-" * 60)
+    print(f"Results: {passed} passed, {failed} failed")
+    return failed == 0
+
+
+def test_hub_pagination():
+    """Test that Hub API pages are reassembled in order, with failed pages skipped"""
+    
+    print("\nTesting Hub API pagination...")
+    print("-" * 60)
+    
+    def stub_pages(total, with_count=True, failing=()):
+        """Serve `total` tags as 'tag-N' in pages; later pages answer first to shuffle completion order"""
+        def get_tags_hub_page(namespace, repository, page, page_size=100):
+            if page in failing:
+                raise cleanup.requests.exceptions.ConnectionError(f"page {page} failed")
+            time.sleep(0.01 * max(0, 5 - page))
+            start = (page - 1) * page_size
+            data = {
+                "results": [{"name": f"tag-{i}"} for i in range(start, min(start + page_size, total))],
+                "next": f"page={page + 1}" if start + page_size < total else None,
+            }
+            if with_count:
+                data["count"] = total
+            return data
+        return get_tags_hub_page
+    
+    def names(start, stop):
+        return [f"tag-{i}" for i in range(start, stop)]
+    
+    test_cases = [
+        # (description, stub, expected tag names)
+        ("All pages in order", stub_pages(450), names(0, 450)),
+        ("Single page", stub_pages(40), names(0, 40)),
+        ("Failed middle page skipped", stub_pages(450, failing={3}), names(0, 200) + names(300, 450)),
+        ("No count, follows next links", stub_pages(250, with_count=False), names(0, 250)),
+        ("No count, stops at failed page", stub_pages(350, with_count=False, failing={3}), names(0, 200)),
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for description, stub, expected in test_cases:
+        cleaner = cleanup.DockerHubCleaner("test-user", "test-password")
+        cleaner.get_tags_hub_page = stub
+        result = [tag["name"] for tag in cleaner.get_tags_hub("ns", "repo")]
+        
+        status = "✅" if result == expected else "❌"
+        if result == expected:
             passed += 1
         else:
             failed += 1
             
-        print(f"{status} Date: {str(date_str):30} Should parse: {should_parse:5} Result: {result}")
+        print(f"{status} {description:32} Expected: {len(expected):4} tags Got: {len(result)}")
     
     print("-" * 60)
     print(f"Results: {passed} passed, {failed} failed")
@@ -262,7 +629,13 @@ def main():
     
     # Run tests
     all_passed = test_patterns() and all_passed
+    all_passed = test_classification_precedence() and all_passed
     all_passed = test_date_parsing() and all_passed
+    all_passed = test_retry_after_parsing() and all_passed
+    all_passed = test_invalid_response_retries() and all_passed
+    all_passed = test_rate_limit_headers() and all_passed
+    all_passed = test_tag_created_validation() and all_passed
+    all_passed = test_hub_pagination() and all_passed
     all_passed = test_retention_logic() and all_passed
     all_passed = test_url_encoding() and all_passed
     all_passed = test_repository_parsing() and all_passed